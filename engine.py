@@ -9,7 +9,7 @@ from tqdm import tqdm
 from models.ade_post_processor import AverageDisplacementErrorEvaluator
 
 
-def train_one_epoch(model, dataloader, optimizer, criterion, epoch, device):
+def train_one_epoch(model, dataloader, optimizer, criterion, epoch, device, amp_dtype=None, scaler=None):
     model.train()
     metric_logger = defaultdict(lambda: torchmetrics.MeanMetric().to(device))
 
@@ -17,20 +17,22 @@ def train_one_epoch(model, dataloader, optimizer, criterion, epoch, device):
 
     print_freq = 50
 
-    for i, (samples, targets) in enumerate(progress_bar):
-        samples = samples.to(device)
+    for i, (samples, targets, targets_stacked) in enumerate(progress_bar):
+        samples = samples.to(device, non_blocking=True)
 
-        targets = [[{k: v.to(device) for k, v in t.items()} for t in batch_targets] for batch_targets in targets]
+        targets = [[{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in batch_targets] for batch_targets in targets]
+        targets_stacked = targets_stacked.to(device, non_blocking=True)
 
         # Zero the parameter gradients
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
 
-        # Forward pass
-        out, targets_flat = model(samples, targets)
-        loss_dict = criterion(out, targets_flat)
+        # Forward pass (in mixed precision if amp_dtype is set)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            out, targets_flat = model(samples, targets)
+            loss_dict = criterion(out, targets_stacked)
 
-        weight_dict = criterion.weight_dict
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+            weight_dict = criterion.weight_dict
+            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
 
         # Logic related to reduce
         loss_dict_unscaled = {
@@ -47,10 +49,18 @@ def train_one_epoch(model, dataloader, optimizer, criterion, epoch, device):
             sys.exit(1)
 
         # Backpropagation and optimization
-        losses.backward()
-
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # Add gradient clipping
-        optimizer.step()
+        if scaler is not None:
+            # float16 autocast, the gradients are unscaled before clipping
+            scaler.scale(losses).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # Add gradient clipping
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            losses.backward()
+
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # Add gradient clipping
+            optimizer.step()
 
         # Update metric logger with main loss and each component
         metric_logger['loss'].update(loss_value)
@@ -95,14 +105,15 @@ def evaluate(model, dataloader, criterion, postprocessors, epoch, device):
     with torch.no_grad():
         progress_bar = tqdm(dataloader, desc=f"Eval {epoch}:", leave=True)
 
-        for i, (samples, targets) in enumerate(progress_bar):
-            samples = samples.to(device)
-            targets = [[{k: v.to(device) for k, v in t.items()} for t in batch_targets] for batch_targets in targets]
+        for i, (samples, targets, targets_stacked) in enumerate(progress_bar):
+            samples = samples.to(device, non_blocking=True)
+            targets = [[{k: v.to(device, non_blocking=True) for k, v in t.items()} for t in batch_targets] for batch_targets in targets]
+            targets_stacked = targets_stacked.to(device, non_blocking=True)
 
             # Forward pass
             out, targets_flat = model(samples, targets)
 
-            loss_dict = criterion(out, targets_flat)
+            loss_dict = criterion(out, targets_stacked)
 
             weight_dict = criterion.weight_dict
             losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
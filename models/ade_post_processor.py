@@ -2,6 +2,8 @@ import numpy as np
 import torch
 from torch import nn
 
+from util.misc import Targets
+
 class AverageDisplacementErrorEvaluator:
 
     def __init__(self, matcher, img_size):
@@ -20,6 +22,8 @@ class AverageDisplacementErrorEvaluator:
         outputs (dict): Dictionary containing the model's predicted outputs.
         targets (list): List of dictionaries containing the ground-truth target data.
         """
+        targets = Targets.from_list(targets)
+
         # Match predictions to targets
         indices = self.matcher(outputs, targets)
 
@@ -28,7 +32,7 @@ class AverageDisplacementErrorEvaluator:
         src_cps = outputs['pred_center_points'][idx] # Predicted center points
         src_cps *= torch.tensor([self.img_size, self.img_size], dtype=torch.float32)
 
-        target_cps = torch.cat([t['center_points'][i] for t, (_, i) in zip(targets, indices)], dim=0)  # True center points
+        target_cps = targets.center_points_padded[self._get_tgt_permutation_idx(indices)]  # True center points
         target_cps *= torch.tensor([self.img_size, self.img_size], dtype=torch.float32)
 
         displacements = torch.norm(src_cps - target_cps, dim=1).detach().cpu()  # Shape: [N, 1]
@@ -71,10 +75,20 @@ class AverageDisplacementErrorEvaluator:
 
     def _get_src_permutation_idx(self, indices):
       # permute predictions following indices
-      batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
+      batch_idx = self._get_batch_idx(indices)
       src_idx = torch.cat([src for (src, _) in indices])
       return batch_idx, src_idx
 
+    def _get_tgt_permutation_idx(self, indices):
+      # permute targets following indices
+      batch_idx = self._get_batch_idx(indices)
+      tgt_idx = torch.cat([tgt for (_, tgt) in indices])
+      return batch_idx, tgt_idx
+
+    def _get_batch_idx(self, indices):
+      sizes = torch.as_tensor([len(src) for (src, _) in indices])
+      return torch.repeat_interleave(torch.arange(len(indices)), sizes)
+
 
 class PostProcessTrajectory(nn.Module):
 
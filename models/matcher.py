@@ -1,7 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import torch.nn as nn
 from scipy.optimize import linear_sum_assignment
 
+from util.misc import Targets
+
+
+@torch.jit.script
+def _sigmoid_focal_cost(out_prob, alpha: float, gamma: float):
+    neg_cost_class = (1 - alpha) * (out_prob ** gamma) * (-(1 - out_prob + 1e-8).log())
+    pos_cost_class = alpha * ((1 - out_prob) ** gamma) * (-(out_prob + 1e-8).log())
+    return pos_cost_class - neg_cost_class
+
+
+@torch.jit.script
+def sigmoid_focal_cost(logits, tgt_ids, alpha: float, gamma: float):
+    """Focal classification cost between queries and GTs
+
+    The elementwise chain runs on the smaller of [batch_size, num_queries, num_target] and
+    [batch_size, num_queries, num_classes] and is fused by the JIT. Usually there are fewer
+    GTs than classes and the logits are gathered by the GT labels first. Otherwise the labels
+    repeat, the cost is computed once per class and gathered afterwards.
+
+    Params:
+        logits: Tensor of dim [batch_size, num_queries, num_classes] with the classification logits
+        tgt_ids: Tensor of dim [batch_size, num_target] with the GT labels
+    """
+    index = tgt_ids.unsqueeze(1).expand(-1, logits.size(1), -1)
+    if tgt_ids.size(1) > logits.size(2):
+        return _sigmoid_focal_cost(logits.sigmoid(), alpha, gamma).gather(-1, index)
+    return _sigmoid_focal_cost(logits.gather(-1, index).sigmoid(), alpha, gamma)
+
+
 class HungarianMatcher(nn.Module):
     """This class computes an assignment between the targets and the predictions of the network
 
@@ -11,7 +42,7 @@ class HungarianMatcher(nn.Module):
     """
 
     def __init__(self, focal_loss, cost_class: float = 1, cost_center_point: float = 1,
-                 focal_alpha: float = 0.25, focal_gamma: float = 2.0,):
+                 focal_alpha: float = 0.25, focal_gamma: float = 2.0, num_threads: int = 1):
         """Creates the matcher
 
         Params:
@@ -20,6 +51,8 @@ class HungarianMatcher(nn.Module):
                        in the matching cost
             cost_giou: This is the relative weight of the giou loss of the bounding box in the
                        matching cost
+            num_threads: Number of threads used to solve the assignments of the batch indices
+                         in parallel (scipy releases the GIL). 1 solves them serially
         """
         super().__init__()
         self.cost_class = cost_class
@@ -30,12 +63,22 @@ class HungarianMatcher(nn.Module):
         self.focal_gamma = focal_gamma
         self.focal_loss = focal_loss
 
+        self.num_threads = num_threads
+        self._executor = None
+
+        # Host buffer the cost matrix is copied into, reused across the calls
+        self._cost_buf = None
+
         assert cost_class != 0 or cost_center_point != 0, "all costs cant be 0"
 
     @torch.no_grad()
     def forward(self, outputs, targets):
 
-        batch_size, num_queries = outputs["pred_logits"].shape[:2]
+        # Under autocast the outputs may be in reduced precision. The classification cost and
+        # the assignment are always computed in float32, the center point cost is computed
+        # in the precision of the outputs (see _cost_matrix)
+        pred_logits = outputs["pred_logits"].float()
+        pred_center_points = outputs["pred_center_points"]
 
         # There're 2 cases for this clss
         # 1. w/o temporal dimention:
@@ -44,64 +87,101 @@ class HungarianMatcher(nn.Module):
         # batch size dimention represents number of frames in the sequence
         # (we do not support multiple sequences in the batch)
 
-        # We flatten to compute the cost matrices in a batch
+        if not isinstance(targets, Targets):
+            targets = Targets.from_list(targets)
+
+        # Number of GTs per each batch index
+        # [batch_size]
+        sizes = targets.sizes.tolist()
+
+        # Queries of one batch index are never matched against GTs of another one,
+        # so we only compute the per batch index blocks of the cost matrix against
+        # the padded GTs. Columns of the padding are set to +inf.
         #
-        # [batch_size * num_queries, num_classes]
-        if self.focal_loss:
-            out_prob = outputs["pred_logits"].flatten(0, 1).sigmoid()
+        # [batch_size, num_queries, max_size]
+        cost_matrix = self._cost_matrix(pred_logits, pred_center_points, targets)
+        cost_matrix = cost_matrix.masked_fill(~targets.mask.unsqueeze(1), float('inf'))
+
+        cost_matrix = self._to_cpu(cost_matrix)
+
+        cost_blocks = [c[:, :size].numpy() for c, size in zip(cost_matrix, sizes)]
+
+        if self.num_threads > 1:
+            indices = list(self._get_executor().map(linear_sum_assignment, cost_blocks))
         else:
-            out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
+            indices = [linear_sum_assignment(c) for c in cost_blocks]
 
-        # [batch_size * num_queries, 2]
-        out_center_points = outputs["pred_center_points"].flatten(0, 1)
+        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
+                for i, j in indices]
 
-        # Also concat the target labels and boxes
-        tgt_ids = torch.cat([v["labels"] for v in targets])
+    def _to_cpu(self, cost_matrix):
+        if not cost_matrix.is_cuda:
+            return cost_matrix
 
-        tgt_center_points = torch.cat([v["center_points"] for v in targets])
+        # The assignment is solved on the host, so like .cpu() this waits for all the work
+        # queued on the stream before the copy (the forward pass included). The copy itself
+        # is staged through pinned memory instead of pageable memory
+        cost_matrix_cpu = self._get_cost_buf(cost_matrix.shape, pin_memory=True)
+        cost_matrix_cpu.copy_(cost_matrix, non_blocking=True)
 
-        if self.focal_loss:
-            # Compute the classification cost.
-            neg_cost_class = (1 - self.focal_alpha) * (out_prob ** self.focal_gamma) * (-(1 - out_prob + 1e-8).log())
-            pos_cost_class = self.focal_alpha * ((1 - out_prob) ** self.focal_gamma) * (-(out_prob + 1e-8).log())
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+        copy_done.synchronize()
 
-            # tgt_ids - concatenated GT label ids
-            # Per each query we contains logits per all labes
-            # [batch_size * num_queries, batch_size]
-            cost_class = pos_cost_class[:, tgt_ids] - neg_cost_class[:, tgt_ids]
-        else:
-            # Compute the classification cost. Contrary to the loss, we don't use the NLL,
-            # but approximate it in 1 - proba[target class].
-            # The 1 is a constant that doesn't change the matching, it can be ommitted.
-            cost_class = -out_prob[:, tgt_ids]
+        return cost_matrix_cpu
 
-        # Compute the L1 cost between center points
-        cost_center_points = torch.cdist(out_center_points, tgt_center_points, p=1)
+    def _get_cost_buf(self, shape, pin_memory):
+        # Contiguous view of the cached flat host buffer with the given shape. A contiguous
+        # destination lets the copy go straight into the (pinned) buffer. The buffer is only
+        # reallocated when it is too small
+        numel = shape.numel()
+        if self._cost_buf is None or self._cost_buf.numel() < numel:
+            self._cost_buf = torch.empty(numel, pin_memory=pin_memory)
+        return self._cost_buf[:numel].view(shape)
 
-        # Final cost matrix
-        # [batch_size * num_queries, batch_size]
-        cost_matrix = self.cost_class * cost_class \
-              + self.cost_center_point * cost_center_points
+    def _get_executor(self):
+        # The pool is created lazily and reused across the calls
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
 
-        # [batch_size, num_queries, batch_size]
-        cost_matrix = cost_matrix.view(batch_size, num_queries, -1).cpu()
+    def _cost_matrix(self, logits, center_points, targets):
+        """Computes the matching cost between the queries and the padded GTs of each batch index
 
-        # Number of GTs per each batch index
-        # [batch_size]
-        sizes = [len(v["labels"]) for v in targets] # Changed from targets to labels
+        Params:
+            logits: Tensor of dim [batch_size, num_queries, num_classes] with the classification logits
+            center_points: Tensor of dim [batch_size, num_queries, 2] with the predicted center points
+            targets: Targets with the padded GTs
 
-        # Split returns a tuple where each element has hape [batch_size, num_queries, size]
-        # During enumeration we assign particular batch index between query and GT size
-        indices = [linear_sum_assignment(c[i])
-                   for i, c in enumerate(cost_matrix.split(sizes, -1))]
+        Returns:
+            Tensor of dim [batch_size, num_queries, max_size]
+        """
+        tgt_ids = targets.labels_padded
+        tgt_center_points = targets.center_points_padded
 
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64))
-                for i, j in indices]
+        if self.focal_loss:
+            # Compute the classification cost.
+            # [batch_size, num_queries, max_size]
+            cost_class = sigmoid_focal_cost(logits, tgt_ids, self.focal_alpha, self.focal_gamma)
+        else:
+            # Compute the classification cost. Contrary to the loss, we don't use the NLL,
+            # but approximate it in 1 - proba[target class].
+            # The 1 is a constant that doesn't change the matching, it can be ommitted.
+            cost_class = -logits.softmax(-1).gather(-1, tgt_ids.unsqueeze(1).expand(-1, logits.size(1), -1))
+
+        # Compute the L1 cost between center points. With only 2 coordinates an explicit
+        # broadcast is cheaper than torch.cdist. It runs in the dtype of the predictions
+        # (half under autocast), the rounding error is negligible for the matching
+        # [batch_size, num_queries, max_size]
+        tgt_center_points = tgt_center_points.to(center_points.dtype)
+        cost_center_points = (center_points.unsqueeze(2) - tgt_center_points.unsqueeze(1)).abs().sum(-1).float()
 
+        return self.cost_class * cost_class + self.cost_center_point * cost_center_points
 
 def build_matcher(args):
     return HungarianMatcher(
         focal_loss=args.focal_loss,
         cost_class = 2,
         cost_center_point = 5,
+        num_threads=args.matcher_threads,
     )
@@ -3,7 +3,7 @@ import torch.nn.functional as F
 from torch import nn
 
 from models.matcher import build_matcher
-from util.misc import sigmoid_focal_loss, accuracy
+from util.misc import sigmoid_focal_loss, accuracy, Targets
 
 
 class SetCriterion(nn.Module):
@@ -24,13 +24,13 @@ class SetCriterion(nn.Module):
 
     def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
         """Classification loss (NLL)
-        targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
+        targets must contain "labels_padded" containing a tensor of dim [batch_size, max_size]
         """
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']
 
         idx = self._get_src_permutation_idx(indices)
-        target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
+        target_classes_o = targets.labels_padded[self._get_tgt_permutation_idx(indices)]
         target_classes = torch.full(src_logits.shape[:2], self.num_classes,
                                     dtype=torch.int64, device=src_logits.device)
         target_classes[idx] = target_classes_o
@@ -45,7 +45,7 @@ class SetCriterion(nn.Module):
 
     def loss_labels_focal(self, outputs, targets, indices, num_objects, log=True):
         """Classification loss (NLL)
-        targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
+        targets must contain "labels_padded" containing a tensor of dim [batch_size, max_size]
         """
         assert 'pred_logits' in outputs
 
@@ -55,23 +55,20 @@ class SetCriterion(nn.Module):
         # (batch_ids, output_query_ids)
         idx = self._get_src_permutation_idx(indices)
 
-        target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
-        device = next(iter(outputs.values())).device
-        # [batch_size, number_queries]
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=device)
-
-        target_classes[idx] = target_classes_o
-
-        # [batch_size, number_queries, number_of_classes+1]
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], src_logits.shape[2] + 1],
-                                            dtype=src_logits.dtype, layout=src_logits.layout, device=device)
-
-        #
-        target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
+        target_classes_o = targets.labels_padded[self._get_tgt_permutation_idx(indices)]
 
         # [batch_size, number_queries, number_of_classes]
-        target_classes_onehot = target_classes_onehot[:,:,:-1]
+        target_classes_onehot = torch.zeros_like(src_logits)
+
+        if self.num_classes < src_logits.shape[2]:
+            # The no-object class has its own logit, unmatched queries target it
+            # [batch_size, number_queries]
+            target_classes = torch.full(src_logits.shape[:2], self.num_classes,
+                                        dtype=torch.int64, device=src_logits.device)
+            target_classes[idx] = target_classes_o
+            target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1)
+        else:
+            target_classes_onehot[idx[0], idx[1], target_classes_o] = 1
 
         loss_ce = sigmoid_focal_loss(
             src_logits, target_classes_onehot, num_objects,
@@ -88,13 +85,13 @@ class SetCriterion(nn.Module):
 
     def loss_center_points(self, outputs, targets, indices, num_objects, log=True):
         """L1 center point loss
-        targets dicts must contain the key "center_points" containing a tensor of dim [nb_target_boxes, 2]
+        targets must contain "center_points_padded" containing a tensor of dim [batch_size, max_size, 2]
         """
         assert 'pred_center_points' in outputs
 
         idx = self._get_src_permutation_idx(indices)
         src_cps = outputs['pred_center_points'][idx]
-        target_cps = torch.cat([t['center_points'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        target_cps = targets.center_points_padded[self._get_tgt_permutation_idx(indices)]
 
         loss_cp = F.l1_loss(src_cps, target_cps, reduction='none')
 
@@ -104,11 +101,14 @@ class SetCriterion(nn.Module):
         return losses
 
     def forward(self, outputs, targets):
+        if not isinstance(targets, Targets):
+            targets = Targets.from_list(targets)
+
         indecies = self.matcher(outputs, targets)
 
-        num_objects = sum(len(t["labels"]) for t in targets)
+        num_objects = len(targets.labels_cat)
         num_objects = torch.as_tensor(
-            [num_objects], dtype=torch.float, device=next(iter(outputs.values())).device)
+            [num_objects], dtype=torch.float, device=outputs['pred_logits'].device)
 
         losses = {}
 
@@ -124,16 +124,24 @@ class SetCriterion(nn.Module):
 
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
+        batch_idx = self._get_batch_idx(indices)
         src_idx = torch.cat([src for (src, _) in indices])
         return batch_idx, src_idx
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
+        batch_idx = self._get_batch_idx(indices)
         tgt_idx = torch.cat([tgt for (_, tgt) in indices])
         return batch_idx, tgt_idx
 
+    def _get_batch_idx(self, indices):
+        # [number_of_matches], the batch index repeated for each of its matched pairs
+        sizes = [len(src) for (src, _) in indices]
+        device = indices[0][0].device
+        return torch.repeat_interleave(
+            torch.arange(len(sizes), device=device), torch.tensor(sizes, device=device),
+            output_size=sum(sizes))
+
 
 def build_criterion(args):
     assert 'moving-mnist' in args.dataset.lower()
@@ -37,17 +37,22 @@ def parse_args():
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--focal_loss', action='store_true')
+    parser.add_argument('--matcher_threads', type=int, default=1, help='Number of threads used to solve the matching assignments')
 
     parser.add_argument('--resume', type=str, default=None, help='Path to checkpoint file to resume training')
     parser.add_argument('--output_dir', type=str, default=None, required=True, help='Output directory')
 
     parser.add_argument('--train_val_split_ratio', type=float, default=0.8, help='Train-validation split ratio')
     parser.add_argument('--device', type=str, default='cuda', help='Device to use (e.g., cpu or cuda)')
+    parser.add_argument('--compile', action='store_true', help='Compile the model and the focal loss with torch.compile')
+    parser.add_argument('--amp', action='store_true', help='Train with autocast mixed precision')
+    parser.add_argument('--amp_dtype', type=str, default='bfloat16', choices=['bfloat16', 'float16'], help='Autocast dtype')
 
     # Dataset
     parser.add_argument('--dataset', type=str, default='moving-mnist', help='Dataset name')
     parser.add_argument('--num_objects', nargs='+', type=int, default=[2], help='Number of digits on the frame')
-    parser.add_argument('--num_workers', type=int, default=0, help='Number of workers')
+    parser.add_argument('--num_workers', type=int, default=4, help='Number of workers')
+    parser.add_argument('--prefetch_factor', type=int, default=4, help='Number of batches loaded in advance by each worker')
     parser.add_argument('--train_dataset_fraction', type=float, default=1, help='Train dataset fraction')
     parser.add_argument('--num_frames', type=int, default=8, help='Number of frames')
     parser.add_argument('--img_size', type=int, default=128, help='Image size')
@@ -96,6 +101,13 @@ def main(args):
     np.random.seed(args.seed)
     random.seed(args.seed)
 
+    # Input shapes are fixed during the training, let cuDNN pick the fastest kernels
+    # and allow TF32 matmuls and convolutions on Ampere+ GPUs
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     device = torch.device(args.device)
 
     # Paths and directories
@@ -113,10 +125,12 @@ def main(args):
     sampler_train = torch.utils.data.RandomSampler(dataset_train)
     sampler_val = torch.utils.data.SequentialSampler(dataset_val)
 
+    # The train dataset changes its frame dropout probability and shuffles its ids between the epochs,
+    # persistent workers would keep a stale copy of it
     dataloader_train = DataLoader(dataset_train, sampler=sampler_train, batch_size=args.batch_size,
-                                  collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True)
+                                  **get_dataloader_kwargs(args, persistent_workers=False))
     dataloader_val = DataLoader(dataset_val, sampler=sampler_val, batch_size=args.batch_size,
-                                collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True)
+                                **get_dataloader_kwargs(args, persistent_workers=True))
 
     dataloader_val_blind = None
     dataset_val_blind = None
@@ -124,10 +138,12 @@ def main(args):
         dataset_val_blind = build_dataset('val', args, frame_dropout_pattern=args.frame_dropout_pattern)
         sampler_val_blind = torch.utils.data.SequentialSampler(dataset_val_blind)
         dataloader_val_blind = DataLoader(dataset_val_blind, sampler=sampler_val_blind, batch_size=args.batch_size,
-                                          collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=True)
+                                          **get_dataloader_kwargs(args, persistent_workers=True))
 
     # Model, criterion, optimizer, and scheduler
     model = build_model(args)
+    # The parameters have to be on the device before the optimizer is built (fused AdamW)
+    model = model.to(device)
     postprocessors = {'trajectory': PostProcessTrajectory()}
 
     def match_name_keywords(n, name_keywords):
@@ -151,10 +167,15 @@ def main(args):
 
     print(f'Params sizes: {[len(p["params"]) for p in param_dicts]}')
 
-    optimizer = torch.optim.AdamW(param_dicts, lr=args.learning_rate, weight_decay=args.weight_decay)
+    optimizer = torch.optim.AdamW(param_dicts, lr=args.learning_rate, weight_decay=args.weight_decay,
+                                  fused=device.type == 'cuda')
     criterion = build_criterion(args)
     lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=args.scheduler_step_size, gamma=0.1)
 
+    amp_dtype = getattr(torch, args.amp_dtype) if args.amp else None
+    # float16 gradients need loss scaling to not underflow, bfloat16 has the float32 range
+    scaler = torch.amp.GradScaler(device.type) if amp_dtype == torch.float16 else None
+
     patience = args.patience
     current_patience = 0
     start_epoch = 0
@@ -172,8 +193,8 @@ def main(args):
             start_epoch = checkpoint['epoch'] + 1
             current_patience = checkpoint['current_patience']
             best_val_loss = checkpoint['best_val_loss']
-
-    model = model.to(device)
+            if scaler is not None and 'scaler' in checkpoint:
+                scaler.load_state_dict(checkpoint['scaler'])
 
     for state in optimizer.state.values():
         for k, v in state.items():
@@ -182,6 +203,12 @@ def main(args):
 
     criterion = criterion.to(device)
 
+    # Checkpoints are saved from the original module to keep the state dict keys unprefixed
+    model_without_compile = model
+    if args.compile:
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+        criterion.loss_labels_focal = torch.compile(criterion.loss_labels_focal)
+
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('Number of parameters:', n_parameters)
 
@@ -217,7 +244,8 @@ def main(args):
         return
 
     for epoch in range(start_epoch, args.epochs):
-        train_stats = train_one_epoch(model, dataloader_train, optimizer, criterion, epoch, device)
+        train_stats = train_one_epoch(model, dataloader_train, optimizer, criterion, epoch, device,
+                                      amp_dtype=amp_dtype, scaler=scaler)
 
         blind_stats = {}
         test_stats = {}
@@ -249,14 +277,17 @@ def main(args):
             wandb.log(log_stats, step=epoch)
 
         if val_loss < best_val_loss or epoch % 2 == 0 or epoch + 1 == args.epochs:
-            torch.save({
-                'model': model.state_dict(),
+            checkpoint = {
+                'model': model_without_compile.state_dict(),
                 'optimizer': optimizer.state_dict(),
                 'lr_scheduler': lr_scheduler.state_dict(),
                 'epoch': epoch,
                 'current_patience': current_patience,
                 'best_val_loss': best_val_loss
-            }, checkpoint_path)
+            }
+            if scaler is not None:
+                checkpoint['scaler'] = scaler.state_dict()
+            torch.save(checkpoint, checkpoint_path)
             best_val_loss = val_loss
             current_patience = 0
             print(f"Checkpoint saved at epoch {epoch} with val loss {val_loss:.4f}")
@@ -279,6 +310,21 @@ def main(args):
     print('Training time {}'.format(total_time_str))
 
 
+def get_dataloader_kwargs(args, persistent_workers):
+    result = {
+        'collate_fn': collate_fn,
+        'num_workers': args.num_workers,
+        'pin_memory': True,
+    }
+
+    # Only valid with worker processes
+    if args.num_workers > 0:
+        result['prefetch_factor'] = args.prefetch_factor
+        result['persistent_workers'] = persistent_workers
+
+    return result
+
+
 def get_wandb_init_config(args):
     result = {
         'project': args.wandb_project
@@ -1,15 +1,69 @@
 import os
 import subprocess
+from dataclasses import dataclass, fields
 
 import torch
 import torch.distributed as dist
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+
+@dataclass
+class Targets:
+    """Targets of the frames stacked into tensors (structure of arrays)
+
+    The frames play the role of the batch dimension of the matcher and the criterion.
+
+    labels_cat: [sum(sizes)] labels of all the frames concatenated
+    center_points_cat: [sum(sizes), 2] center points of all the frames concatenated
+    sizes: [num_frames] number of targets per frame, kept on the host
+    labels_padded: [num_frames, max(sizes)] labels padded with 0
+    center_points_padded: [num_frames, max(sizes), 2] center points padded with 0
+    mask: [num_frames, max(sizes)] True for the real (not padded) targets
+    """
+    labels_cat: torch.Tensor
+    center_points_cat: torch.Tensor
+    sizes: torch.Tensor
+    labels_padded: torch.Tensor
+    center_points_padded: torch.Tensor
+    mask: torch.Tensor
+
+    @classmethod
+    def from_list(cls, targets):
+        labels = [t['labels'] for t in targets]
+        # Frames without targets have 1-D empty center points
+        center_points = [t['center_points'].reshape(-1, 2) for t in targets]
+
+        sizes = torch.as_tensor([len(l) for l in labels], dtype=torch.int64)
+        mask = torch.arange(int(sizes.max())) < sizes.unsqueeze(1)
+
+        return cls(
+            labels_cat=torch.cat(labels),
+            center_points_cat=torch.cat(center_points),
+            sizes=sizes,
+            labels_padded=pad_sequence(labels, batch_first=True),
+            center_points_padded=pad_sequence(center_points, batch_first=True),
+            mask=mask,
+        )
+
+    def to(self, device, non_blocking=False):
+        # sizes drive the Python-level slicing, so they stay on the host
+        return Targets(**{
+            f.name: getattr(self, f.name) if f.name == 'sizes'
+            else getattr(self, f.name).to(device, non_blocking=non_blocking)
+            for f in fields(self)})
+
+    def pin_memory(self):
+        # Called by the DataLoader with pin_memory=True
+        return Targets(**{f.name: getattr(self, f.name).pin_memory() for f in fields(self)})
 
 
 def collate_fn(batch):
     batch = list(zip(*batch))
     batch[0] = torch.stack(batch[0])
     batch[1] = list(batch[1])
+    # The frames of all the sequences are stacked, like the model flattens them
+    batch.append(Targets.from_list([t for sequence_targets in batch[1] for t in sequence_targets]))
     return tuple(batch)
 
 